@@ -8,10 +8,22 @@
 
 
 ## Import
-from subprocess import check_output as call
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from io import open
-import json
+from itertools import islice
+import csv
 import os
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# decode the API responses with orjson if it is installed (much faster for large pages),
+# otherwise fall back on the json module
+try:
+    from orjson import loads
+except ImportError:
+    from json import loads
 
 
 ## Parameters
@@ -25,35 +37,55 @@ taxa = ["MX.44394", "MX.44109"]  # liverworts and bryophytes
 # folder in which to save the results (ignored if running from command line)
 folderpath = "/Users/tapani/T/Courses/2020/new_mosses"
 
+# number of specimens downloaded per page, and number of pages downloaded at the same time
+# (only about 'downloads' pages are kept in memory at a time, so small pages keep memory use down,
+# while downloading several at a time keeps the download speed up)
+pageSize = 1000
+downloads = 10
+
 # whether to get only specimens which can be placed in a Finnish biogeographical province, or all specimens
 onlyFIprovinces = True
 
 
 ## Helper functions
 
+# session for getting stuff from the API
+# keeps the connection open, so that it can be reused for every call
+SESSION = requests.Session()
+SESSION.headers["Accept"] = "application/json"
+SESSION.headers["Accept-Encoding"] = "gzip, deflate"  # ask for compressed responses (requests decompresses them)
+SESSION.params = {"access_token": access_token}
+# retry requests that get a busy or failed response a few times, waiting a bit longer each time
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=downloads, max_retries=Retry(total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])))
+
+# thread pool for downloading several pages from the API at the same time
+pool = ThreadPoolExecutor(max_workers=downloads)
+
 # function for getting stuff from the API
-def get(apiurl):
-    res = call(["curl", "-X", "GET", "--header", "Accept: application/json", apiurl])
-    return json.loads(res)
-
-# function for checking if a specific combination of keys exists in a dictionary
-# keys:  the keys in hierarchical order, e.g. ['unit','linkings', 'taxon', 'id']
-def exists(x, keys):
-    # start from the top level of keys
-    level = x
+def get(apiurl, params=None):
+    res = SESSION.get(apiurl, params=params, timeout=60)
+    res.raise_for_status()  # stop at once if the API returned an error (e.g. too many requests)
+    return loads(res.content)
+
+# get every page of a paginated search from the API, one page at a time
+# the first page tells how many pages there are, the rest are downloaded several at a time
+# while the earlier pages are being processed (at most 'downloads' pages ahead, to limit memory use)
+def getpages(apiurl, params):
+    # get the first page
+    first = get(apiurl, dict(params, page=1))
     
-    # drill down through the levels of x
-    for key in keys:
-        # if the key exists, go down one level
-        if key in level:
-            level = level[key]
-            
-        # if the key was not found, return False
-        else:
-            return False
+    # start getting the next few pages in parallel
+    pages = iter(range(2, first['lastPage'] + 1))
+    futs = deque(pool.submit(get, apiurl, dict(params, page=page)) for page in islice(pages, downloads))
     
-    # return True if all the keys were found
-    return True
+    # hand over the pages in order, each as soon as it has been downloaded
+    # and start getting a new page for each one handed over
+    yield first
+    while futs:
+        fut = futs.popleft()
+        for page in islice(pages, 1):
+            futs.append(pool.submit(get, apiurl, dict(params, page=page)))
+        yield fut.result()
 
 
 ## Initialise
@@ -65,54 +97,58 @@ try:
 # if copy-pasting into python, save into the folder given in the parameters
 except NameError:
     path = folderpath
-    
-    
+
+# addresses of the parts of the API that are used
+areasurl = "https://api.laji.fi/v0/areas"
+unitsurl = "https://api.laji.fi/v0/warehouse/query/unit/list"
+
+# search settings common to the specimen searches
+# (preserved specimens of the taxa we're interested in, identified to species and without quality issues)
+unitparams = {
+    "cache": "false",
+    "taxonId": ",".join(taxa),
+    "useIdentificationAnnotations": "true",
+    "includeSubTaxa": "true",
+    "includeNonValidTaxa": "true",
+    "taxonRankId": "MX.species",
+    "recordBasis": "PRESERVED_SPECIMEN",
+    "individualCountMin": 1,
+    "qualityIssues": "NO_ISSUES"
+}
+
+
 ## Check if specimens have valid species names
 
 # get the biogeographical provinces from the API
 # format: {province id: province name}
 print("\nDownloading biogeographical provinces")
-url = "https://api.laji.fi/v0/areas?type=biogeographicalProvince&lang=fi&pageSize=50&access_token=" + access_token
-js = get(url)
+js = get(areasurl, {"type": "biogeographicalProvince", "lang": "fi", "pageSize": 50})
 provinces = {}
 for area in js['results']:
     provinces[area['id']] = area['name']
 
-# if asked to only include specimens placed in a biogeographical province,
-# add the relevant string to the API url
-if (onlyFIprovinces):
-    getProvince = "&biogeographicalProvinceId=" + "%2C".join(list(provinces.keys()))
-    
-# otherwise, get all specimens
-else:
-    getProvince = ""
-
-# initialise variables for specimen data download
-page = 1
-loop = True
-
 # initialise list into which the specimen ids of specimens without a valid species ID will be saved
 noTaxon = []
 
-# get specimens from the API, one page (10000 specimens) at a time
-while loop:
-    # get from API
-    url = "https://api.laji.fi/v0/warehouse/query/unit/list?selected=document.documentId%2Cunit.linkings.taxon.id%2Cunit.unitId&pageSize=10000&page=" + str(page) + "&cache=false&taxonId=" + ",".join(taxa) + "&useIdentificationAnnotations=true&includeSubTaxa=true&includeNonValidTaxa=true&taxonRankId=MX.species" + getProvince + "&recordBasis=PRESERVED_SPECIMEN&individualCountMin=1&qualityIssues=NO_ISSUES&access_token=" + access_token
-    js = get(url)
-    
-    # stop when the last page is done
-    if ( js['currentPage'] >= js['lastPage'] ):
-        loop = False
-        
-    # go to next page
-    page += 1
-    
+# set up the specimen search, with only the fields that are actually used
+params = dict(unitparams,
+    selected=",".join(["document.documentId", "unit.linkings.taxon.id", "unit.unitId"]),
+    pageSize=pageSize
+)
+
+# if asked to only include specimens placed in a biogeographical province, add them to the search
+# (otherwise, get all specimens)
+if (onlyFIprovinces):
+    params["biogeographicalProvinceId"] = ",".join(provinces.keys())
+
+# get specimens from the API, one page at a time, several pages in parallel
+for js in getpages(unitsurl, params):
     # loop through the specimens, check if they have a valid species ID
     for sp in js['results']:
         # save specimens that do not have a species ID to 'noTaxon'
-        if not exists(sp, ['unit', 'linkings','taxon','id']):
+        if 'id' not in sp['unit'].get('linkings', {}).get('taxon', {}):
             # save the unit ID if the specimen is a multi-species observation
-            if exists(sp, ['unit','unitId']):
+            if ('unitId' in sp['unit']):
                 id = sp['unit']['unitId']
                 
             # otherwise, save the specimen ID
@@ -124,14 +160,14 @@ while loop:
 
 # open a file in which the specimens without a valid species ID will be saved
 filepath = os.path.join(path, "mistyped_speciesnames.csv")
-f = open(filepath, "w", encoding="utf-8")
+f = open(filepath, "w", encoding="utf-8", newline="", buffering=1<<20)
+w = csv.writer(f, lineterminator="\n")
 
 # write the header to the file
-tmp = f.write(u"species" + "\n")
+w.writerow(["species"])
 
 # write the specimens to the file
-for line in sorted(noTaxon):
-    tmp = f.write(line + u"\n")
+w.writerows([line] for line in sorted(noTaxon))
 
 # close the file
 f.close()
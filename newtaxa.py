@@ -9,10 +9,26 @@
 
 
 ## Import
-from subprocess import check_output as call
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
 from io import open
-import json
+from itertools import islice
+import csv
+from operator import itemgetter
 import os
+from sys import argv, intern
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# decode the API responses with orjson if it is installed (much faster for large pages),
+# otherwise fall back on the json module
+try:
+    from orjson import loads
+except ImportError:
+    from json import loads
 
 
 ## Parameters
@@ -26,74 +42,91 @@ taxa = ["MX.44394", "MX.44109"]  # liverworts and bryophytes
 # folder in which to save the results (ignored if running from command line)
 folderpath = "/Users/tapani/T/Courses/2020/new_mosses"
 
+# number of specimens downloaded per page, and number of pages downloaded at the same time
+# (only about 'downloads' pages are kept in memory at a time, so small pages keep memory use down,
+# while downloading several at a time keeps the download speed up)
+pageSize = 1000
+downloads = 10
+
+# how many hours downloaded Taxon Editor data is saved on disk and reused, instead of downloading it again
+# (to download it again anyway, run the script with --refresh or set this to 0)
+cacheHours = 24
+
 # texts in Taxon Editor which should be interpreted as representing an occurrence
 # There are a bewildering variety of occurrence classifications, see
 # http://schema.laji.fi/alt/MX.typeOfOccurrenceEnum
 occursStrings = ["MX.typeOfOccurrenceOccurs", "MX.typeOfOccurrenceStablePopulation", "MX.typeOfOccurrenceCommon", "MX.typeOfOccurrenceRare", "MX.typeOfOccurrenceVeryRare", "MX.typeOfOccurrenceImport", "MX.typeOfOccurrenceAnthropogenic", "MX.typeOfOccurrenceAlienOldResident", "MX.typeOfOccurrenceSpontaneousNewEphemeral", "MX.typeOfOccurrenceAlienNewEphemeral", "MX.typeOfOccurrenceAlienNewResident", "MX.typeOfOccurrenceSmallDegreeCultivatedOrigin", "MX.typeOfOccurrenceNotableDegreeCultivatedOrigin", "MX.typeOfOccurrenceCompletelyCultivatedOrigin", "MX.typeOfOccurrenceOnlyCultivated"]
 
+# occurrence codes in Taxon Editor for old distribution records
+# new occurrences of species with these codes are ignored if all the specimens are from before 1940
+oldStrings = {"MX.typeOfOccurrenceOldRecords", "MX.typeOfOccurrenceExtirpated"}
+
 
 ## Helper functions
 
+# session for getting stuff from the API
+# keeps the connection open, so that it can be reused for every call
+SESSION = requests.Session()
+SESSION.headers["Accept"] = "application/json"
+SESSION.headers["Accept-Encoding"] = "gzip, deflate"  # ask for compressed responses (requests decompresses them)
+SESSION.params = {"access_token": access_token}
+# retry requests that get a busy or failed response a few times, waiting a bit longer each time
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=downloads, max_retries=Retry(total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])))
+
+# thread pool for downloading several things from the API at the same time
+pool = ThreadPoolExecutor(max_workers=downloads)
+
+# download stuff from the API, without decoding it
+def fetch(apiurl, params=None):
+    res = SESSION.get(apiurl, params=params, timeout=60)
+    res.raise_for_status()  # stop at once if the API returned an error (e.g. too many requests)
+    return res.content
+
 # get stuff from the API
-def get(apiurl):
-    res = call(["curl", "-X", "GET", "--header", "Accept: application/json", apiurl])
-    return json.loads(res)
-
-# get the order into which a list will be sorted
-def order(x, reverse=False):
-    o = sorted(range(len(x)), key=x.__getitem__, reverse=reverse)
-    return o
-
-# sort a list into a specific order
-def sort(x, o):
-    # create new empty list
-    newToProvinces = []
-    
-    # add the items in 'x' in the correct order
-    for i in o:
-        newToProvinces.append(x[i])
+def get(apiurl, params=None):
+    return loads(fetch(apiurl, params))
+
+# get stuff from the API, or from a file saved by an earlier run if the file is recent enough
+# the file is (re)saved whenever the data is downloaded
+# name:  start of the file name; a short hash of the search is added, so that changing the search does not reuse old files
+def getcached(name, apiurl, params=None):
+    # find the file for this search
+    search = apiurl + "?" + repr(sorted((params or {}).items()))
+    cachefile = os.path.join(cachepath, name + "_" + sha1(search.encode("utf-8")).hexdigest()[:10] + ".json")
     
-    # return the new list
-    return(newToProvinces)
-
-# check if a specific combination of keys exists in a dictionary
-# keys:  the keys in hierarchical order, e.g. ['unit','linkings', 'taxon', 'id']
-def exists(x, keys):
-    # start from the top level of keys
-    level = x
-    
-    # drill down through the levels of x
-    for key in keys:
-        # if the key exists, go down one level
-        if key in level:
-            level = level[key]
-            
-        # if the key was not found, return False
-        else:
-            return False
+    # use the saved file if it is recent enough
+    if (not refresh) and os.path.exists(cachefile) and (time.time() - os.path.getmtime(cachefile) < cacheHours * 3600):
+        with open(cachefile, "rb") as f:
+            return loads(f.read())
     
-    # return True if all the keys were found
-    return True
-
-# check if a specific combination of keys exists in a dictionary,
-# return its value if it exists, or 'ifnot' if it doesn't.
-# keys:  the keys in hierarchical order, e.g. ['unit','linkings', 'taxon', 'id']
-def check(x, keys, ifnot=""):
-    # start from the top level of keys
-    level = x
+    # otherwise, download from the API and save the response to the file
+    # (written to a temporary file first, so that an interrupted run cannot leave a half-written file behind)
+    content = fetch(apiurl, params)
+    tmpfile = cachefile + ".tmp"
+    with open(tmpfile, "wb") as f:
+        f.write(content)
+    os.replace(tmpfile, cachefile)
+    return loads(content)
+
+# get every page of a paginated search from the API, one page at a time
+# the first page tells how many pages there are, the rest are downloaded several at a time
+# while the earlier pages are being processed (at most 'downloads' pages ahead, to limit memory use)
+def getpages(apiurl, params):
+    # get the first page
+    first = get(apiurl, dict(params, page=1))
     
-    # drill down through the levels of x
-    for key in keys:
-        # if the key exists, go down one level
-        if key in level:
-            level = level[key]
-            
-        # if the key was not found, return the value in 'ifnot'
-        else:
-            return ifnot
+    # start getting the next few pages in parallel
+    pages = iter(range(2, first['lastPage'] + 1))
+    futs = deque(pool.submit(get, apiurl, dict(params, page=page)) for page in islice(pages, downloads))
     
-    # return the value if all the keys were found
-    return level
+    # hand over the pages in order, each as soon as it has been downloaded
+    # and start getting a new page for each one handed over
+    yield first
+    while futs:
+        fut = futs.popleft()
+        for page in islice(pages, 1):
+            futs.append(pool.submit(get, apiurl, dict(params, page=page)))
+        yield fut.result()
 
 
 ## Initialise
@@ -106,30 +139,89 @@ try:
 except NameError:
     path = folderpath
 
+# whether to download the Taxon Editor data even if a recent copy has been saved
+refresh = "--refresh" in argv[1:]
+
+# folder in which downloaded Taxon Editor data is saved between runs
+cachepath = os.path.join(os.path.expanduser("~"), ".cache", "finbif")
+os.makedirs(cachepath, exist_ok=True)
+
+# addresses of the parts of the API that are used
+areasurl = "https://api.laji.fi/v0/areas"
+taxaurl = "https://api.laji.fi/v0/taxa/"
+unitsurl = "https://api.laji.fi/v0/warehouse/query/unit/list"
+
+# search settings common to the specimen searches
+# (preserved specimens of the taxa we're interested in, identified to species and without quality issues)
+unitparams = {
+    "cache": "false",
+    "taxonId": ",".join(taxa),
+    "useIdentificationAnnotations": "true",
+    "includeSubTaxa": "true",
+    "includeNonValidTaxa": "true",
+    "taxonRankId": "MX.species",
+    "recordBasis": "PRESERVED_SPECIMEN",
+    "individualCountMin": 1,
+    "qualityIssues": "NO_ISSUES"
+}
+
+
+## Start downloading
+
+# the biogeographical provinces, the Taxon Editor data and the specimens new to Finland do not depend on each other,
+# so start downloading them all at the same time (each is only waited for when it is first needed)
+print("\nDownloading biogeographical provinces, Taxon Editor data and specimens new to Finland")
+
+# start getting the biogeographical provinces from the API
+futProvinces = pool.submit(get, areasurl, {"type": "biogeographicalProvince", "lang": "fi", "pageSize": 50})
+
+# start getting the known distributions for the taxa we're interested in (liverworts and bryophytes)
+# these change slowly, so reuse a copy saved by a recent run if there is one
+params = {
+    "lang": "fi",
+    "langFallback": "true",
+    "taxonRanks": "MX.species",
+    "includeHidden": "false",
+    "includeMedia": "false",
+    "includeDescriptions": "false",
+    "includeRedListEvaluations": "false",
+    "selectedFields": ",".join(["id", "scientificNameDisplayName", "occurrences"]),
+    "onlyFinnish": "true",
+    "sortOrder": "taxonomic",
+    "pageSize": 1000
+}
+futTE = []
+for taxon in taxa:
+    futTE.append(pool.submit(getcached, "te_" + taxon, taxaurl + taxon + "/species", params))
+
+# start getting Finnish specimens of species not known to occur in Finland from the API
+# (with only the fields that are actually used)
+params = dict(unitparams,
+    selected=",".join(["document.documentId", "document.modifiedDate", "gathering.eventDate.end", "unit.interpretations.reliability", "unit.linkings.taxon.id", "unit.linkings.taxon.scientificName", "unit.unitId"]),
+    pageSize=100,
+    page=1,
+    finnish="false",
+    countryId="ML.206"
+)
+futFI = pool.submit(get, unitsurl, params)
+
 
 ## Check for new occurrences in biogeographical provinces
 
-# get the biogeographical provinces from the API
+# get the biogeographical provinces
 # format: {province id: province name}
-print("\nDownloading biogeographical provinces")
-url = "https://api.laji.fi/v0/areas?type=biogeographicalProvince&lang=fi&pageSize=50&access_token=" + access_token
-js = get(url)
+js = futProvinces.result()
 provinces = {}
 for area in js['results']:
     provinces[area['id']] = area['name']
 
-# let the user know we will get the currently known distributions (=Taxon Editor data) from the API
-print("\nDownloading Taxon Editor data")
-
 # set up two variables with format:  {species: {province: occurrenceCode}}
 occurrencesTE = {}  # only those species-province pairs where the species occurs
 occurrencesTEall = {}  # all species-province pairs (used to get occurrence codes)
 
 # get the known distributions for the taxa we're interested in (liverworts and bryophytes)
-for taxon in taxa:
-    # get from api
-    url = "https://api.laji.fi/v0/taxa/" + taxon + "/species?lang=fi&langFallback=true&taxonRanks=MX.species&includeHidden=false&includeMedia=false&includeDescriptions=false&includeRedListEvaluations=false&selectedFields=id%2CscientificNameDisplayName%2Coccurrences&onlyFinnish=true&sortOrder=taxonomic&pageSize=1000&access_token=" + access_token
-    js = get(url)
+for fut in futTE:
+    js = fut.result()
     
     # save into the two variables one species at a time
     for sp in js['results']:
@@ -158,31 +250,31 @@ for taxon in taxa:
 # let the user know we will get the specimen data from the API
 print("\nDownloading specimen data")
 
-# initialise variables for specimen data download
-page = 1
-loop = True
-
 # set up variable 'occurrences' with format:
-# { species: { province: { occurrenceCode: XXX, speciesName: XXX, specimens : [{specimenID: XXX, modifiedDate: XXX, gatheredDate: XXX, reliability: XXX}] } } }
-occurrences = {}
-
-# get data from the API, one page (10000 specimens) at a time
-while loop:
-    # get from api
-    url = "https://api.laji.fi/v0/warehouse/query/unit/list?selected=document.createdDate%2Cdocument.documentId%2Cdocument.modifiedDate%2Cgathering.eventDate.end%2Cgathering.interpretations.biogeographicalProvince%2Cunit.interpretations.reliability%2Cunit.linkings.taxon.id%2Cunit.linkings.taxon.scientificName%2Cunit.unitId&pageSize=10000&page=" + str(page) + "&cache=false&taxonId=" + ",".join(taxa) + "&useIdentificationAnnotations=true&includeSubTaxa=true&includeNonValidTaxa=true&taxonRankId=MX.species&biogeographicalProvinceId=" + "%2C".join(list(provinces.keys())) + "&recordBasis=PRESERVED_SPECIMEN&individualCountMin=1&qualityIssues=NO_ISSUES&access_token=" + access_token
-    js = get(url)
-    
+# { species: { province: { occurrenceCode: XXX, speciesName: XXX, specimenIDs: [XXX], modifiedDates: [XXX], gatheredDates: [XXX], reliabilities: [XXX] } } }
+occurrences = defaultdict(dict)
+
+# set up the specimen search, with only the fields that are actually used
+params = dict(unitparams,
+    selected=",".join(["document.documentId", "document.modifiedDate", "gathering.eventDate.end", "gathering.interpretations.biogeographicalProvince", "unit.interpretations.reliability", "unit.linkings.taxon.id", "unit.linkings.taxon.scientificName", "unit.unitId"]),
+    pageSize=pageSize,
+    biogeographicalProvinceId=",".join(provinces.keys())
+)
+
+# get data from the API, one page at a time, several pages in parallel
+for js in getpages(unitsurl, params):
     # loop through each specimen, add its data to 'occurrences'
     for sp in js["results"]:
         # only add specimens whose species name is typed correctly (by checking if sp is in TE)
-        if exists(sp, ['unit', 'linkings', 'taxon', 'id']):
+        taxon = sp['unit'].get('linkings', {}).get('taxon', {})
+        if ('id' in taxon):
             # extract (and tidy up) the species id and province id of this specimen
-            species = sp['unit']['linkings']['taxon']['id'].replace("http://tun.fi/", "")
-            area = sp['gathering']['interpretations']['biogeographicalProvince'].replace("http://tun.fi/", "")
+            species = taxon['id'].removeprefix("http://tun.fi/")
+            area = sp['gathering']['interpretations']['biogeographicalProvince'].removeprefix("http://tun.fi/")
             
             # extract the occurrenceCode and species name
-            occurrenceCode = check(occurrencesTEall, [species, area])
-            speciesName = sp['unit']['linkings']['taxon']['scientificName']
+            occurrenceCode = occurrencesTEall.get(species, {}).get(area, "")
+            speciesName = taxon['scientificName']
             
             # extract the unit id for multi-species observations
             if ("unitId" in sp['unit']):
@@ -193,148 +285,74 @@ while loop:
                 specimenID = sp['document']['documentId']
                 
             # extract the date when the data was modified and the specimen gathered
-            modifiedDate = check(sp, ['document', 'modifiedDate'])
-            gatheredDate = check(sp, ['gathering', 'eventDate', 'end'])
+            # these (and reliability) repeat across many specimens, so intern them to keep only one copy of each in memory
+            modifiedDate = intern(sp['document'].get('modifiedDate', ""))
+            gatheredDate = intern(sp.get('gathering', {}).get('eventDate', {}).get('end', ""))
             
             # extract the data on how reliable the observation is
-            reliability = sp['unit']['interpretations']['reliability']
+            reliability = intern(sp['unit']['interpretations']['reliability'])
             
-            # if this species is not yet in occurrences,
-            # add a new species then save all the extracted data there
-            if (species not in occurrences):
-                occurrences[species] = {area: { "occurrenceCode": occurrenceCode, "speciesName": speciesName, "specimens": [{"specimenID": specimenID, "modifiedDate": modifiedDate, "gatheredDate": gatheredDate, "reliability": reliability}] }}
-            
-            # if the species already exists in occurrences,
-            # add the extracted data to it
-            else:
-                oc = occurrences[species]
-                
-                # add the province if it does not already exist, then add the data to it
-                if (area not in oc):
-                    oc[area] = { "occurrenceCode": occurrenceCode, "speciesName": speciesName, "specimens": [{"specimenID": specimenID, "modifiedDate": modifiedDate, "gatheredDate": gatheredDate, "reliability": reliability}] }
-                    
-                # else if the province already exists, add the data to it
-                else:
-                    oc[area]['specimens'].append( {"specimenID": specimenID, "modifiedDate": modifiedDate, "gatheredDate": gatheredDate, "reliability": reliability} )
-                    
-    # end the loop if the last page has been reached
-    if ( js['currentPage'] >= js['lastPage'] ):
-        loop = False
-    
-    # go to the next page of specimens
-    page += 1
+            # add the species and province to 'occurrences' if they are not there yet, then add the extracted data
+            # (the new province is only built when needed, rather than for every specimen as setdefault would)
+            oc = occurrences[species].get(area)
+            if (oc is None):
+                oc = occurrences[species][area] = { "occurrenceCode": occurrenceCode, "speciesName": speciesName, "specimenIDs": [], "modifiedDates": [], "gatheredDates": [], "reliabilities": [] }
+            oc['specimenIDs'].append(specimenID)
+            oc['modifiedDates'].append(modifiedDate)
+            oc['gatheredDates'].append(gatheredDate)
+            oc['reliabilities'].append(reliability)
+
+# compare the specimen data to the known occurrences (Taxon editor data)
+# the new occurrences (new species-province pairs) are filtered, their specimens sorted by date,
+# then saved here in human-readable format, one row per species-province pair:
+# [ (species, speciesName, province, occurrenceCode, specimens, modifiedDates, gatheredDates, reliabilities) ]
+newToProvinces = []
 
-# start comparing the specimen data to the known occurrences (Taxon editor data)
-# initialise variable for the new occurrences (new species-province pairs), format:
-# [ [species, speciesName, province, occurrenceCode, [specimens], [modifiedDates], [gatheredDates], [reliabilities]] ]
-notinTE = []
+# shortcut for joining the specimen data of each row into one field (saves looking up " ".join for every field)
+join = " ".join
 
 # check each species to see if there are specimens outside the known distribution
-for sp in occurrences.keys():
+for sp in occurrences:
     # only check species that are in TE (others are probably mistypes)
-    if (sp in occurrencesTE.keys()):
-        # loop through each province for this species
-        for area in occurrences[sp].keys():
-            # if the occurrence is new, extract the data and save in 'notinTE'
-            if (area not in occurrencesTE[sp]):
-                # extract the occurrence code and species name
-                occurrenceCode = occurrences[sp][area]['occurrenceCode']
-                speciesName = occurrences[sp][area]['speciesName']
-                
-                # extract the specimens found here
-                sps = occurrences[sp][area]['specimens']
-                
-                # extract the data for the specimens
-                specimens = []
-                modifiedDates = []
-                gatheredDates = []
-                reliabilities = []
-                for specimen in sps:
-                    specimens.append(specimen['specimenID'])
-                    modifiedDates.append(specimen['modifiedDate'])
-                    gatheredDates.append(specimen['gatheredDate'])
-                    reliabilities.append(specimen['reliability'])
-                    
-                # save into 'notinTE'
-                notinTE.append([sp, speciesName, area, occurrenceCode, specimens, modifiedDates, gatheredDates, reliabilities])
-
-# initialise a variable for the new occurrences
-# the data in 'notinTE' will be filtered, sorted, converted into human-readable format, then saved here
-newToProvinces = []
-
-# filter out e.g. old distribution records
-for i in notinTE:
-    # get the data of this species
-    line = list(i)
-    
-    # initialise boolean showing whether this data should be included or not
-    include = True
+    if (sp not in occurrencesTE):
+        continue
     
-    # filter 1: ignore old distribution records if all the specimens are from before 1940
-    if ( (line[3] == 'MX.typeOfOccurrenceOldRecords') or (line[3] == 'MX.typeOfOccurrenceExtirpated') ):
-        # initialise whether there are specimens from 1940 or later
-        recentYear = False
+    # loop through each province where this species has specimens
+    for area in occurrences[sp]:
+        # only keep the provinces where the species is not known to occur (i.e. the new occurrences)
+        if (area in occurrencesTE[sp]):
+            continue
         
-        # check if any of the specimens are recent
-        for gatheredDate in line[6]:
-            # only check specimens with a date
-            if (not gatheredDate==""):
-                if (int(gatheredDate[0:4]) >= 1940):
-                    recentYear = True
+        # get the data for this species and province
+        oc = occurrences[sp][area]
+        occurrenceCode = oc['occurrenceCode']
+        
+        # filter 1: ignore old distribution records if all the specimens are from before 1940
+        # (only specimens with a date are checked; the dates start with a four-digit year, so the years can be compared as text)
+        if (occurrenceCode in oldStrings) and not any(gatheredDate[0:4] >= "1940" for gatheredDate in oc['gatheredDates'] if gatheredDate):
+            continue
         
-        # filter out this species if no specimens were recent (and its occurrence data is old)
-        if (not recentYear):
-            include = False
-            
-    # after the filters, save the species if not filtered away
-    # also take the opportunity to sort the specimens by date
-    if (include):
         # sort the specimens by modifiedDate
-        o = order(line[5], reverse=True)
-        line[4] = sort(line[4], o)
-        line[5] = sort(line[5], o)
-        line[6] = sort(line[6], o)
-        line[7] = sort(line[7], o)
+        specimens, modifiedDates, gatheredDates, reliabilities = zip(*sorted(zip(oc['specimenIDs'], oc['modifiedDates'], oc['gatheredDates'], oc['reliabilities']), key=itemgetter(1), reverse=True))
         
         # save into 'newToProvinces' in human-readable format
-        line[0] = "http://tun.fi/" + line[0]
-        line[2] = provinces[line[2]]
-        line[4] = " ".join(line[4])
-        line[5] = " ".join(line[5])
-        line[6] = " ".join(line[6])
-        line[7] = " ".join(line[7])
-        newToProvinces.append(line)
-
-# get the most recent dates when specimens were modified for each species
-# these will be used to sort the data
-modifiedDate = []
-for i in newToProvinces:
-    modifiedDate.append(i[5])
+        newToProvinces.append(("http://tun.fi/" + sp, oc['speciesName'], provinces[area], occurrenceCode, join(specimens), join(modifiedDates), join(gatheredDates), join(reliabilities)))
 
-# sort the new occurrences by the most recent date when a specimen was modified
-o = order(modifiedDate, reverse=True)
-newToProvinces = sort(newToProvinces, o)
-
-# get the occurrence codes of each species
-# these will be used to sort the data
-occurrenceCode = []
-for i in newToProvinces:
-    occurrenceCode.append(i[3])
-
-# sort the new occurrences by occurrence code
-o = order(occurrenceCode)
-newToProvinces = sort(newToProvinces, o)
+# sort the new occurrences by occurrence code, and within each code by the most recent date when a specimen was modified
+# (sorting is stable, so sorting by date first keeps the dates in order within each occurrence code)
+newToProvinces.sort(key=itemgetter(5), reverse=True)
+newToProvinces.sort(key=itemgetter(3))
 
 # open a file in which the new occurrences will be saved
 filepath = os.path.join(path, "new_to_bioprovinces.csv")
-f = open(filepath, "w", encoding="utf-8")
+f = open(filepath, "w", encoding="utf-8", newline="", buffering=1<<20)
+w = csv.writer(f, lineterminator="\n")
 
 # write the header to the file
-tmp = f.write(u"species,speciesName,province,occurrenceCode,specimens,modifiedDate,collectedDate,reliability" + "\n")
+w.writerow(["species", "speciesName", "province", "occurrenceCode", "specimens", "modifiedDate", "collectedDate", "reliability"])
 
 # write the data of each species with new occurrences to the file
-for line in newToProvinces:
-    tmp = f.write(u",".join(line) + "\n")
+w.writerows(newToProvinces)
 
 # close the file
 f.close()
@@ -342,38 +360,35 @@ f.close()
 
 ## Check for new species to Finland
 
-# let the user know we will get specimens which are new to Finland from the API
-print("\nDownloading data on specimens new to Finland")
-
 # set up variable for the species not known to be in Finland with format:
 # { species: [ species, speciesName, [specimenIDs], [modifiedDates], [gatheredDates], [reliabilities] ] }
 notinFI = {}
 
-# get Finnish specimens of species not known to occur in Finland from the API
-url = "https://api.laji.fi/v0/warehouse/query/unit/list?selected=document.createdDate%2Cdocument.documentId%2Cdocument.modifiedDate%2Cgathering.eventDate.end%2Cgathering.interpretations.biogeographicalProvince%2Cunit.interpretations.reliability%2Cunit.linkings.taxon.id%2Cunit.linkings.taxon.scientificName%2Cunit.unitId&pageSize=100&page=1&cache=false&taxonId=" + ",".join(taxa) + "&useIdentificationAnnotations=true&includeSubTaxa=true&includeNonValidTaxa=true&finnish=false&taxonRankId=MX.species&countryId=ML.206&recordBasis=PRESERVED_SPECIMEN&individualCountMin=1&qualityIssues=NO_ISSUES&access_token=" + access_token
-js = get(url)
+# get Finnish specimens of species not known to occur in Finland
+js = futFI.result()
 
 # loop through each specimen, add its data to 'notinFI'
 for sp in js["results"]:
     # # only add specimens whose species name is typed correctly (by checking if sp is in TE)
-    if exists(sp, ['unit', 'linkings', 'taxon', 'id']):
+    taxon = sp['unit'].get('linkings', {}).get('taxon', {})
+    if ('id' in taxon):
         # extract (and tidy up) the species id for this specimen
-        species = sp['unit']['linkings']['taxon']['id'].replace("http://tun.fi/", "")
+        species = taxon['id'].removeprefix("http://tun.fi/")
         
         # extract the species name
-        speciesName = sp['unit']['linkings']['taxon']['scientificName']
+        speciesName = taxon['scientificName']
         
         # extract the unit id for multi-species observations
-        if ("unitId" in sp['unit']['linkings']):
-            specimenID = sp['unit']['linkings']['unitId']
+        if ("unitId" in sp['unit']):
+            specimenID = sp['unit']['unitId']
             
         # otherwise, extract the specimen id
         else:
             specimenID = sp['document']['documentId']
             
         # extract the date when the data was modified and the specimen gathered
-        modifiedDate = check(sp, ['document', 'modifiedDate'])
-        gatheredDate = check(sp, ['gathering', 'eventDate', 'end'])
+        modifiedDate = sp['document'].get('modifiedDate', "")
+        gatheredDate = sp.get('gathering', {}).get('eventDate', {}).get('end', "")
         
         # extract the data on how reliable the observation is
         reliability = sp['unit']['interpretations']['reliability']
@@ -391,49 +406,31 @@ for sp in js["results"]:
             notinFI[species][5].append(reliability)
 
 # initialise a variable for the new occurrences
-# the data in notinFI will be sorted and converted into human-readable format, then saved here
+# the specimens of each species in 'notinFI' will be sorted by the date when their data was modified,
+# then saved here in human-readable format, one row per species
 newToFI = []
 
-#  sort the specimens of each species by the date when their data was modified, and save in human-readable format
-for i in notinFI:
-    # get the data of this species
-    line = list(notinFI[i])
-    
+# sort and convert the data one species at a time
+for species, speciesName, specimens, modifiedDates, gatheredDates, reliabilities in notinFI.values():
     # sort the specimens by date modified
-    o = order(line[3], reverse=True)
-    line[2] = sort(line[2], o)
-    line[3] = sort(line[3], o)
-    line[4] = sort(line[4], o)
-    line[5] = sort(line[5], o)
+    specimens, modifiedDates, gatheredDates, reliabilities = zip(*sorted(zip(specimens, modifiedDates, gatheredDates, reliabilities), key=itemgetter(1), reverse=True))
     
     # add this species to 'newToFI' in human-readable format
-    line[0] = "http://tun.fi/" + line[0]
-    line[2] = " ".join(line[2])
-    line[3] = " ".join(line[3])
-    line[4] = " ".join(line[4])
-    line[5] = " ".join(line[5])
-    newToFI.append(line)
-
-# get the most recent dates when specimens were modified for each species
-# these will be used to sort the data
-modifiedDate = []
-for i in newToFI:
-    modifiedDate.append(i[3])
+    newToFI.append(("http://tun.fi/" + species, speciesName, join(specimens), join(modifiedDates), join(gatheredDates), join(reliabilities)))
 
 # sort the new occurrences by the most recent date when a specimen was modified
-o = order(modifiedDate, reverse=True)
-newToFI = sort(newToFI, o)
+newToFI.sort(key=itemgetter(3), reverse=True)
 
 # open a file in which the new occurrences will be saved
 filepath = os.path.join(path, "new_to_fi.csv")
-f = open(filepath, "w", encoding="utf-8")
+f = open(filepath, "w", encoding="utf-8", newline="", buffering=1<<20)
+w = csv.writer(f, lineterminator="\n")
 
 # write the header to the file
-tmp = f.write(u"species,speciesName,specimens,modifiedDate,collectedDate,reliability" + "\n")
+w.writerow(["species", "speciesName", "specimens", "modifiedDate", "collectedDate", "reliability"])
 
 # write the data of each species with new occurrences to the file
-for line in newToFI:
-    tmp = f.write(u",".join(line) + "\n")
+w.writerows(newToFI)
 
 # close the file
 f.close()